@@ -1,60 +1,103 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
+import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
+from itertools import islice, repeat
 from pathlib import Path
 
+sys.path.append(str(Path(__file__).parent.parent))
+
 import classyclick
 import click
 import requests
-from opensearchpy import NotFoundError, OpenSearch
-from opensearchpy.helpers import streaming_bulk
+from opensearchpy import OpenSearch
+from opensearchpy.helpers import bulk, streaming_bulk
 from tqdm import tqdm
 
+from utils.household import Household
+
+# free text fields, indexed for prefix / as-you-type lookups while keeping the `.keyword` of dynamic mappings
+SEARCH_MAPPING = {'type': 'search_as_you_type', 'fields': {'keyword': {'type': 'keyword', 'ignore_above': 256}}}
+
+# documents whose hash and month are fetched at once (with mget) to find the months changed by a push
+MGET_BATCH_SIZE = 500
+
+# explicit mappings for the transactions index, anything else is dynamically mapped
+MAPPINGS = {
+    'properties': {
+        'tenant': {'type': 'keyword'},
+        # month (YYYY-MM) and hash of the content when pushed, to find the summary buckets changed by a push
+        'month': {'type': 'keyword'},
+        'content_hash': {'type': 'keyword', 'index': False},
+        'comment': SEARCH_MAPPING,
+        'transaction': {
+            'properties': {
+                'name': SEARCH_MAPPING,
+                'payee': SEARCH_MAPPING,
+                'payee_key': {'type': 'keyword'},
+            }
+        },
+    }
+}
+
+# explicit mappings for the monthly summary index, one document per tenant x month x account x category
+SUMMARY_MAPPINGS = {
+    'properties': {
+        'tenant': {'type': 'keyword'},
+        'month': {'type': 'date', 'format': 'yyyy-MM'},
+        'amount': {
+            'properties': {
+                'sum': {'type': 'double'},
+                'count': {'type': 'long'},
+                'min': {'type': 'double'},
+                'max': {'type': 'double'},
+            }
+        },
+    }
+}
+
+
+def mapping_types(mappings: dict, prefix=''):
+    """Flatten `mappings` into the type of each field, by its dotted path"""
+    types = {}
+    for name, mapping in mappings.get('properties', {}).items():
+        if 'type' in mapping:
+            types[f'{prefix}{name}'] = mapping['type']
+        types.update(mapping_types(mapping, f'{prefix}{name}.'))
+    return types
+
 
 @classyclick.command()
 class Push:
-    input: Path = classyclick.argument()
+    inputs: list[str] = classyclick.argument(nargs=-1, required=True, type=str, metavar='[TENANT=]INPUT...')
     index: str = classyclick.option(default='pocketmoney-transactions')
+    summary_index: str = classyclick.option(
+        default='pocketmoney-monthly', help='Index with the monthly summary per account and category'
+    )
     os_host: str = classyclick.option(default='localhost')
     os_port: int = classyclick.option(default=9200)
     osd_host: str = classyclick.option(default='localhost')
     osd_port: int = classyclick.option(default=5601)
     dashboard: Path = classyclick.option(default='dashboard.ndjson', help='Path to the dashboard export')
     reset: bool = classyclick.option(help='Reset the index and re-import the dashboard, even if they already exist')
+    shards: int = classyclick.option(
+        default=1, help='Number of shards of the index (when created), tenants are routed to a single shard each'
+    )
+    jobs: int = classyclick.option(default=4, help='Number of inputs (tenants) pushed concurrently')
 
     @cached_property
-    def data(self):
-        return json.loads(self.input.read_text())
-
-    @cached_property
-    def accounts(self):
-        objs = {}
-        for obj in self.data['ICAccount']['data']:
-            if obj['ID'] in objs:
-                raise ValueError(f'Account {obj["ID"]} already exists')
-            objs[obj['ID']] = obj
-        return objs
-
-    @cached_property
-    def categories(self):
-        objs = {}
-        for obj in self.data['ICCategory']['data']:
-            if obj['ID'] in objs:
-                raise ValueError(f'Category {obj["ID"]} already exists')
-            objs[obj['ID']] = obj
-        return objs
-
-    @cached_property
-    def transactions(self):
-        objs = {}
-        for obj in self.data['ICTransaction']['data']:
-            if obj['ID'] in objs:
-                raise ValueError(f'Transaction {obj["ID"]} already exists')
-            obj['account'] = self.accounts[obj['account']]
-            objs[obj['ID']] = obj
-        return objs
+    def households(self):
+        households = {}
+        for spec in self.inputs:
+            household = Household.from_spec(spec, 'opensearch')
+            if household.tenant in households:
+                raise ValueError(f'Tenant {household.tenant} already exists')
+            households[household.tenant] = household
+        return households
 
     @cached_property
     def client(self):
@@ -70,68 +113,202 @@ class Push:
     def osd_client(self):
         return OSDClient(self.osd_host, self.osd_port)
 
-    def generate_documents(self):
-        for trans in self.data['ICTransactionSplit']['data']:
-            # Create a document ID from the transaction's primary key
-            doc_id = trans['ID']
-            del trans['ID']
-
-            trans['amount'] = float(trans['amount'])
-            trans['transaction'] = self.transactions[trans['transaction']]
-            if trans['category']:
-                trans['category'] = self.categories[trans['category']]
+    def generate_documents(self, household: Household, affected_months: set):
+        """
+        Generate the documents of `household`, each fully replacing its existing version.
+        Documents carry a hash of their content and their month, fetched beforehand (in batches) for the existing
+        versions, to add the months of created or changed documents (both previous and new) to `affected_months`.
+        """
+        splits = household.splits()
+        while batch := list(islice(splits, MGET_BATCH_SIZE)):
+            docs = {}
+            for trans in batch:
+                # Create a document ID from the tenant and the transaction's primary key
+                doc_id = f'{household.tenant}:{trans["ID"]}'
+                del trans['ID']
+                trans['content_hash'] = hashlib.sha256(json.dumps(trans, sort_keys=True).encode()).hexdigest()
+                trans['month'] = trans['transaction']['date'][:7]
+                docs[doc_id] = trans
 
-            # Prepare the document
-            doc = {'_index': self.index, '_id': doc_id, '_source': trans}
+            r = self.client.mget(
+                index=self.index,
+                body={'ids': list(docs)},
+                routing=household.tenant,
+                _source_includes=['content_hash', 'month'],
+            )
+            for existing in r['docs']:
+                trans = docs[existing['_id']]
+                if existing.get('found'):
+                    if existing['_source'].get('content_hash') == trans['content_hash']:
+                        continue
+                    if 'month' in existing['_source']:
+                        affected_months.add(existing['_source']['month'])
+                affected_months.add(trans['month'])
 
-            yield doc
+            for doc_id, trans in docs.items():
+                yield {'_index': self.index, '_id': doc_id, '_routing': household.tenant, '_source': trans}
 
-    def push_to_os(self):
+    def push_to_os(self, household: Household, position=0):
+        """Push all documents of `household` and return the months that had documents created or changed"""
+        affected_months = set()
         items = streaming_bulk(
             self.client,
-            self.generate_documents(),
+            self.generate_documents(household, affected_months),
             index=self.index,
             raise_on_error=False,
         )
 
         for success, failed in tqdm(
-            items, total=len(self.data['ICTransactionSplit']['data']), desc='Pushing to OpenSearch'
+            items, total=household.split_count, desc=f'Pushing {household.tenant} to OpenSearch', position=position
         ):
             if not success:
                 print('Errors:', json.dumps(failed, indent=2))
+        return affected_months
+
+    def summary_buckets(self, household: Household, months=None):
+        """
+        Aggregate the raw documents of `household` into month x account x category buckets,
+        for `months` only if specified
+        """
+        query = {'bool': {'filter': [{'term': {'tenant': household.tenant}}]}}
+        if months is not None:
+            query['bool']['filter'].append(
+                {
+                    'bool': {
+                        'should': [
+                            {'range': {'transaction.date': {'gte': f'{month}-01', 'lt': f'{month}-01||+1M'}}}
+                            for month in sorted(months)
+                        ]
+                    }
+                }
+            )
+        composite = {
+            'size': 1000,
+            'sources': [
+                {
+                    'month': {
+                        'date_histogram': {
+                            'field': 'transaction.date',
+                            'calendar_interval': 'month',
+                            'format': 'yyyy-MM',
+                        }
+                    }
+                },
+                {'account': {'terms': {'field': 'transaction.account.ID.keyword'}}},
+                {'category': {'terms': {'field': 'category.ID.keyword', 'missing_bucket': True}}},
+            ],
+        }
+        stats = {name: {name: {'field': 'amount'}} for name in ('sum', 'min', 'max')}
+        while True:
+            r = self.client.search(
+                index=self.index,
+                routing=household.tenant,
+                body={'size': 0, 'query': query, 'aggs': {'buckets': {'composite': composite, 'aggs': stats}}},
+            )
+            buckets = r['aggregations']['buckets']
+            yield from buckets['buckets']
+            if 'after_key' not in buckets:
+                break
+            composite['after'] = buckets['after_key']
+
+    def generate_summary_documents(self, household: Household, months=None):
+        for bucket in self.summary_buckets(household, months):
+            key = bucket['key']
+            # buckets might include documents pushed from a previous version of the database
+            account = household.accounts.get(key['account'], {'ID': key['account']})
+            category = household.categories.get(key['category'], {'ID': key['category']}) if key['category'] else None
+            yield {
+                '_index': self.summary_index,
+                '_id': f'{household.tenant}:{key["month"]}:{key["account"]}:{key["category"]}',
+                '_routing': household.tenant,
+                '_source': {
+                    'tenant': household.tenant,
+                    'month': key['month'],
+                    'transaction': {'account': account},
+                    'category': category,
+                    'amount': {
+                        'sum': bucket['sum']['value'],
+                        'count': bucket['doc_count'],
+                        'min': bucket['min']['value'],
+                        'max': bucket['max']['value'],
+                    },
+                },
+            }
+
+    def update_summary(self, household: Household, months=None):
+        """Recompute the summary documents of `household` for `months` (or all of them, if not specified)"""
+        if months is not None and not months:
+            return
+        click.echo(f'Updating {household.tenant} summary for {"all" if months is None else len(months)} month(s)...')
+        self.client.indices.refresh(index=self.index)
+        query = {'bool': {'filter': [{'term': {'tenant': household.tenant}}]}}
+        if months is not None:
+            query['bool']['filter'].append({'terms': {'month': sorted(months)}})
+        self.client.delete_by_query(
+            index=self.summary_index, body={'query': query}, routing=household.tenant, conflicts='proceed'
+        )
+        bulk(self.client, self.generate_summary_documents(household, months))
+
+    def push_household(self, household: Household, rebuild_summary=False, position=0):
+        affected_months = self.push_to_os(household, position=position)
+        self.update_summary(household, None if rebuild_summary else affected_months)
+
+    def outdated_mappings(self):
+        """Fields of `MAPPINGS` mapped differently in the existing index, ie: created by an older version"""
+        r = self.client.indices.get_mapping(index=self.index)
+        existing = mapping_types(next(iter(r.values()))['mappings'])
+        return [field for field, field_type in mapping_types(MAPPINGS).items() if existing.get(field) != field_type]
 
     def setup(self):
-        try:
-            self.client.indices.get(index=self.index)
-            # index exists, assume initial setup is not required unless --reset is used
-            if self.reset:
-                self.client.indices.delete(index=self.index)
-            else:
-                return
-        except NotFoundError:
-            """no index exists, assume initial setup is required, go ahead and setup everything"""
+        """Setup indices, index patterns and dashboard, returns True if the summary index has to be fully rebuilt"""
+        if self.reset:
+            self.client.indices.delete(index=f'{self.index},{self.summary_index}', ignore_unavailable=True)
+        elif self.client.indices.exists(index=self.index):
+            outdated = self.outdated_mappings()
+            if outdated:
+                raise click.ClickException(
+                    f'Index {self.index} has outdated mappings ({", ".join(outdated)}), use --reset to recreate it'
+                )
+            if self.client.indices.exists(index=self.summary_index):
+                # indices exist, assume initial setup is not required unless --reset is used
+                return False
         click.echo('Setting up the index, index pattern and dashboard...')
-        r = self.osd_client.delete_index_pattern(self.index)
-        if r.status_code != 404:
+        if not self.client.indices.exists(index=self.index):
+            self.client.indices.create(
+                index=self.index, body={'settings': {'number_of_shards': self.shards}, 'mappings': MAPPINGS}
+            )
+        self.client.indices.delete(index=self.summary_index, ignore_unavailable=True)
+        self.client.indices.create(
+            index=self.summary_index,
+            body={'settings': {'number_of_shards': self.shards}, 'mappings': SUMMARY_MAPPINGS},
+        )
+        index_patterns = {'pocketmoney-transactions': self.index, 'pocketmoney-monthly': self.summary_index}
+        for index, time_field in ((self.index, 'transaction.date'), (self.summary_index, 'month')):
+            r = self.osd_client.delete_index_pattern(index)
+            if r.status_code != 404:
+                r.raise_for_status()
+            r = self.osd_client.create_index_pattern(index, time_field)
             r.raise_for_status()
-        r = self.osd_client.create_index_pattern(self.index, 'transaction.date')
-        r.raise_for_status()
         objs = [json.loads(line) for line in self.dashboard.read_text().splitlines()]
         for obj in objs:
             if obj.get('type') == 'visualization':
                 for reference in obj.get('references', []):
                     if reference.get('type') == 'index-pattern':
-                        reference['id'] = self.index
+                        reference['id'] = index_patterns.get(reference['id'], self.index)
 
         with tempfile.NamedTemporaryFile(suffix='.ndjson') as f:
             temp = Path(f.name)
             temp.write_text('\n'.join(json.dumps(obj) for obj in objs))
             r = self.osd_client.import_object(temp, overwrite=True)
             r.raise_for_status()
+        return True
 
     def __call__(self):
-        self.setup()
-        self.push_to_os()
+        rebuild_summary = self.setup()
+        households = self.households.values()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            # consume the results to re-raise any exception
+            list(executor.map(self.push_household, households, repeat(rebuild_summary), range(len(households))))
 
 
 class OSDClient(requests.Session):
@@ -2,19 +2,122 @@
 
 import hashlib
 import json
+import queue
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
 from pathlib import Path
 
+sys.path.append(str(Path(__file__).parent.parent))
+
 import classyclick
 import click
 import psycopg2
+import psycopg2.pool
 import requests
 from tqdm import tqdm
 
+from utils.household import Household
+
+# columns with trigram indices, for substring (I)LIKE lookups
+SEARCH_COLUMNS = ['transaction_name', 'transaction_payee', 'comment']
+
+# rows written at once, batches queued per writer before document generation waits for it
+# and batches committed at once by each writer, keeping transactions (and batches kept for retries) short
+BATCH_SIZE = 100
+QUEUE_SIZE = 10
+COMMIT_BATCHES = 50
+
+# end of range marker sent to the writers when document generation fails, instead of None
+ABORT = object()
+
+# errors worth retrying the range of a writer for: lost connections, deadlocks and serialization failures
+RETRYABLE_ERRORS = (psycopg2.OperationalError, psycopg2.errors.TransactionRollbackError)
+
+# category hierarchy levels extracted to their own (indexed) columns, deeper levels are still in `data`
+CATEGORY_LEVELS = 3
+
+# columns generated from `data`, so they can be indexed and queried directly
+GENERATED_COLUMNS = {
+    'transaction_name': "TEXT GENERATED ALWAYS AS (data#>>'{transaction,name}') STORED",
+    'transaction_payee': "TEXT GENERATED ALWAYS AS (data#>>'{transaction,payee}') STORED",
+    'comment': "TEXT GENERATED ALWAYS AS (data->>'comment') STORED",
+    'payee_key': "TEXT GENERATED ALWAYS AS (data#>>'{transaction,payee_key}') STORED",
+    'category_path': "TEXT GENERATED ALWAYS AS (data#>>'{category,path}') STORED",
+    'category_depth': "INT GENERATED ALWAYS AS ((data#>>'{category,depth}')::int) STORED",
+    **{
+        f'category_level_{level}': f"TEXT GENERATED ALWAYS AS (data#>>'{{category,level_{level}}}') STORED"
+        for level in range(1, CATEGORY_LEVELS + 1)
+    },
+}
+
+
+# tenant of each partition of a table, read from the partition bounds
+PARTITION_TENANTS_SQL = r"""
+SELECT replace((regexp_match(pg_get_expr(c.relpartbound, c.oid), '^FOR VALUES IN \(''(.*)''\)$'))[1], '''''', '''')
+FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = %s::regclass
+"""
+
+
+def table_ddl(table: str):
+    """SQL to (re)create the transactions table, list partitioned by tenant"""
+    return f'''
+    DROP TABLE IF EXISTS "{table}";
+    CREATE TABLE "{table}" (
+        tenant TEXT NOT NULL,
+        id TEXT NOT NULL,
+        data JSONB,
+        PRIMARY KEY (tenant, id)
+    ) PARTITION BY LIST (tenant);
+    {upgrade_ddl(table)}
+    '''
+
+
+def upgrade_ddl(table: str):
+    """SQL to add the generated columns and indices missing from the transactions table, keeping its data"""
+    table_hash = hashlib.sha256(table.encode()).hexdigest()
+    columns = ',\n        '.join(
+        f'ADD COLUMN IF NOT EXISTS {column} {definition}' for column, definition in GENERATED_COLUMNS.items()
+    )
+    category_level_indices = '\n    '.join(
+        f'CREATE INDEX IF NOT EXISTS idx_category_level_{level}_{table_hash} ON "{table}" (tenant, category_level_{level});'
+        for level in range(1, CATEGORY_LEVELS + 1)
+    )
+    search_indices = '\n    '.join(
+        f'CREATE INDEX IF NOT EXISTS idx_{column}_trgm_{table_hash} ON "{table}" USING GIN ({column} gin_trgm_ops);'
+        for column in SEARCH_COLUMNS
+    )
+    return f'''
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    ALTER TABLE "{table}"
+        {columns};
+
+    CREATE INDEX IF NOT EXISTS idx_data_gin_{table_hash} ON "{table}" USING GIN (data);
+    CREATE INDEX IF NOT EXISTS idx_category_path_{table_hash} ON "{table}" (tenant, category_path text_pattern_ops);
+    CREATE INDEX IF NOT EXISTS idx_payee_key_{table_hash} ON "{table}" (tenant, payee_key);
+    {search_indices}
+    {category_level_indices}
+    '''
+
+
+def partition_ddl(table: str, tenant: str):
+    """
+    SQL to create the partition of `tenant`, if it does not exist yet.
+    It is named after a hash of the tenant, as PostgreSQL truncates identifiers to 63 bytes and longer names
+    (sharing a prefix) would clash.
+    """
+    tenant_hash = hashlib.sha256(f'{table}:{tenant}'.encode()).hexdigest()[:16]
+    partition = f'{table.encode()[:40].decode(errors="ignore")}:{tenant_hash}'.replace('"', '""')
+    tenant_literal = tenant.replace("'", "''")
+    return f'''CREATE TABLE IF NOT EXISTS "{partition}" PARTITION OF "{table}" FOR VALUES IN ('{tenant_literal}');'''
+
 
 @classyclick.command(context_settings={'show_default': True})
 class Push:
-    input: Path = classyclick.argument()
+    inputs: list[str] = classyclick.argument(nargs=-1, required=True, type=str, metavar='[TENANT=]INPUT...')
     table: str = classyclick.option(default='pocketmoney-transactions')
     pg_host: str = classyclick.option(default='localhost')
     pg_port: int = classyclick.option(default=5432)
@@ -29,46 +132,27 @@ class Push:
         default=Path(__file__).parent / 'dashboard.sample.json', help='Path to the dashboard export'
     )
     reset: bool = classyclick.option(help='Reset the table and re-import the dashboard, even if they already exist')
+    jobs: int = classyclick.option(default=4, help='Number of inputs (tenants) pushed concurrently')
+    workers: int = classyclick.option(
+        default=4, help='Number of parallel writers per tenant, each with its own connection and transaction'
+    )
+    retries: int = classyclick.option(
+        default=3, help='Number of times the uncommitted batches of a failed writer are retried'
+    )
 
     @cached_property
-    def table_hash(self):
-        return hashlib.sha256(self.table.encode()).hexdigest()
-
-    @cached_property
-    def data(self):
-        return json.loads(self.input.read_text())
-
-    @cached_property
-    def accounts(self):
-        objs = {}
-        for obj in self.data['ICAccount']['data']:
-            if obj['ID'] in objs:
-                raise ValueError(f'Account {obj["ID"]} already exists')
-            objs[obj['ID']] = obj
-        return objs
-
-    @cached_property
-    def categories(self):
-        objs = {}
-        for obj in self.data['ICCategory']['data']:
-            if obj['ID'] in objs:
-                raise ValueError(f'Category {obj["ID"]} already exists')
-            objs[obj['ID']] = obj
-        return objs
-
-    @cached_property
-    def transactions(self):
-        objs = {}
-        for obj in self.data['ICTransaction']['data']:
-            if obj['ID'] in objs:
-                raise ValueError(f'Transaction {obj["ID"]} already exists')
-            obj['account'] = self.accounts[obj['account']]
-            objs[obj['ID']] = obj
-        return objs
-
-    @cached_property
-    def client(self):
-        return psycopg2.connect(
+    def households(self):
+        households = {}
+        for spec in self.inputs:
+            household = Household.from_spec(spec, 'postgres')
+            if household.tenant in households:
+                raise ValueError(f'Tenant {household.tenant} already exists')
+            households[household.tenant] = household
+        return households
+
+    @property
+    def connection_params(self):
+        return dict(
             host=self.pg_host,
             port=self.pg_port,
             database=self.pg_database,
@@ -76,67 +160,159 @@ class Push:
             password=self.pg_password,
         )
 
+    @cached_property
+    def client(self):
+        return psycopg2.connect(**self.connection_params)
+
+    @cached_property
+    def pool(self):
+        """connections used by the writers, one for each writer of each tenant pushed concurrently"""
+        return psycopg2.pool.ThreadedConnectionPool(1, self.jobs * self.workers, **self.connection_params)
+
     @cached_property
     def grafana_client(self):
         client = GrafanaClient(self.grafana_host, self.grafana_port)
         client.auth = (self.grafana_user, self.grafana_password)
         return client
 
-    def generate_documents(self):
-        for trans in self.data['ICTransactionSplit']['data']:
-            # Create a document ID from the transaction's primary key
-
-            trans['amount'] = float(trans['amount'])
-            trans['transaction'] = self.transactions[trans['transaction']]
-            if trans['category']:
-                trans['category'] = self.categories[trans['category']]
-
-            yield trans
-
-    def push(self):
-        cursor = self.client.cursor()
-        batch = []
-        for trans in tqdm(self.generate_documents(), desc='Pushing transactions'):
-            batch.append((trans['ID'], json.dumps(trans)))
-            if len(batch) >= 100:
-                cursor.executemany(
-                    f'''INSERT INTO "{self.table}" (id, data) VALUES (%s, %s) ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data''',
-                    batch,
-                )
-                batch = []
-        if batch:
-            cursor.executemany(
-                f'''INSERT INTO "{self.table}" (id, data) VALUES (%s, %s) ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data''',
-                batch,
+    def push(self, household: Household, position=0):
+        # split the documents in disjoint ID hash ranges, one per writer, fed through bounded queues
+        # so writing overlaps with document generation
+        queues = [queue.Queue(maxsize=QUEUE_SIZE) for _ in range(self.workers)]
+        # writers commit as they go, fail on broken references before anything is written
+        household.check_references()
+        with (
+            tqdm(
+                total=household.split_count, desc=f'Pushing {household.tenant} transactions', position=position
+            ) as progress,
+            ThreadPoolExecutor(max_workers=self.workers) as executor,
+        ):
+            futures = [executor.submit(self.write_range, batches, progress) for batches in queues]
+            batches = [[] for _ in range(self.workers)]
+            try:
+                for trans in household.splits():
+                    worker = zlib.crc32(trans['ID'].encode()) % self.workers
+                    batches[worker].append((household.tenant, trans['ID'], json.dumps(trans)))
+                    if len(batches[worker]) == BATCH_SIZE:
+                        queues[worker].put(batches[worker])
+                        batches[worker] = []
+                for worker, batch in enumerate(batches):
+                    if batch:
+                        queues[worker].put(batch)
+            except BaseException:
+                # writers roll back their range instead of committing part of the tenant
+                for batches_queue in queues:
+                    batches_queue.put(ABORT)
+                raise
+            for batches_queue in queues:
+                batches_queue.put(None)
+            stats = [future.result() for future in futures]
+
+        for worker, (rows, elapsed) in enumerate(stats):
+            click.echo(
+                f'{household.tenant} writer {worker}: {rows} rows in {elapsed:.2f}s ({rows / max(elapsed, 1e-6):.0f} rows/s)'
             )
-        self.client.commit()
+
+    def write_range(self, batches: queue.Queue, progress):
+        """
+        Write the batches of rows received from `batches` (until None) with a pooled connection, committing every
+        COMMIT_BATCHES batches (the uncommitted ones are rolled back if ABORT is received instead).
+        On connection failures and serialization conflicts, the uncommitted batches are replayed on a new connection
+        (upserts are idempotent), returns number of rows and elapsed time.
+        """
+        start = time.monotonic()
+        pending = []
+        committed = 0
+        done = False
+        for attempt in range(self.retries + 1):
+            client = None
+            written = 0
+            try:
+                client = self.pool.getconn()
+                cursor = client.cursor()
+                for batch in pending:
+                    self.write_batch(cursor, batch)
+                    written += len(batch)
+                    progress.update(len(batch))
+                while not done:
+                    batch = batches.get()
+                    if batch is ABORT:
+                        client.rollback()
+                        self.pool.putconn(client)
+                        return None
+                    if batch is None:
+                        done = True
+                        break
+                    pending.append(batch)
+                    self.write_batch(cursor, batch)
+                    written += len(batch)
+                    progress.update(len(batch))
+                    if len(pending) == COMMIT_BATCHES:
+                        client.commit()
+                        committed += written
+                        pending = []
+                        written = 0
+                client.commit()
+                committed += written
+                pending = []
+            except Exception as e:
+                if client is not None:
+                    # discard the connection, it might be broken
+                    self.pool.putconn(client, close=True)
+                progress.update(-written)
+                if isinstance(e, RETRYABLE_ERRORS) and attempt < self.retries:
+                    click.echo(f'Writer failed ({e}), retrying its uncommitted batches...', err=True)
+                    continue
+                # keep consuming the range so document generation is not blocked on a full queue
+                while not done:
+                    done = batches.get() in (None, ABORT)
+                raise
+            self.pool.putconn(client)
+            return committed, time.monotonic() - start
+
+    def write_batch(self, cursor, batch):
+        cursor.executemany(
+            f'''INSERT INTO "{self.table}" (tenant, id, data) VALUES (%s, %s, %s) ON CONFLICT (tenant, id) DO UPDATE SET data = EXCLUDED.data''',
+            batch,
+        )
 
     def setup(self):
         try:
-            self.client.cursor().execute(f"""select id from "{self.table}" limit 1""")
+            self.client.cursor().execute(f"""select tenant, id from "{self.table}" limit 1""")
             # table exists, assume initial setup is not required unless --reset is used
             if not self.reset:
-                return
+                # add the columns and indices of newer versions, keeping the data of every tenant
+                self.client.cursor().execute(upgrade_ddl(self.table))
+                self.client.commit()
+                return self.setup_partitions()
         except psycopg2.errors.UndefinedTable:
             """no table exists, assume initial setup is required, go ahead and setup everything"""
             self.client.rollback()
+        except psycopg2.errors.UndefinedColumn:
+            """table created before tenants were supported, it cannot be upgraded in place"""
+            self.client.rollback()
+            if not self.reset:
+                raise click.ClickException(
+                    f'Table {self.table} was created before tenants were supported, use --reset to recreate it'
+                )
 
         click.echo('Setting up the table and dashboard...')
-        self.client.cursor().execute(
-            f'''
-            DROP TABLE IF EXISTS "{self.table}";
-            CREATE TABLE "{self.table}" (
-                id TEXT PRIMARY KEY,
-                data JSONB
-            );
-
-            CREATE INDEX idx_data_gin_{self.table_hash} ON "{self.table}" USING GIN (data);
-            '''
-        )
+        self.client.cursor().execute(table_ddl(self.table))
         self.client.commit()
+        self.setup_partitions()
         self.setup_grafana_datasource()
         self.setup_grafana_dashboard()
 
+    def setup_partitions(self):
+        cursor = self.client.cursor()
+        # tenants might already have a partition with another name (ie: created by an older version)
+        cursor.execute(PARTITION_TENANTS_SQL, (f'"{self.table}"',))
+        existing = {tenant for (tenant,) in cursor.fetchall()}
+        for tenant in self.households:
+            if tenant not in existing:
+                cursor.execute(partition_ddl(self.table, tenant))
+        self.client.commit()
+
     def setup_grafana_datasource(self):
         """Create or update Grafana PostgreSQL datasource via API"""
         click.echo('Setting up Grafana datasource...')
@@ -190,7 +366,13 @@ class Push:
 
     def __call__(self):
         self.setup()
-        self.push()
+        households = self.households.values()
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                # consume the results to re-raise any exception
+                list(executor.map(self.push, households, range(len(households))))
+        finally:
+            self.pool.closeall()
 
 
 class GrafanaClient(requests.Session):
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import re
+from functools import cached_property
+from pathlib import Path
+
+import classyclick
+import click
+import psycopg2
+from push import partition_ddl, table_ddl
+
+# generated splits follow the same document structure as `push.py`, spread over 4 tenants, 10 years,
+# 8 accounts and 20 categories (in 5 groups)
+TENANTS = [f'household-{n}' for n in range(4)]
+DATASET_SQL = """
+INSERT INTO "{table}" (tenant, id, data)
+SELECT
+    'household-' || mod(i, 4),
+    md5('split' || i),
+    jsonb_build_object(
+        'ID', md5('split' || i),
+        'tenant', 'household-' || mod(i, 4),
+        'amount', round((random() * 400 - 300)::numeric, 2),
+        'comment', '',
+        'category', jsonb_build_object(
+            'ID', md5('category' || mod(i, 20)),
+            'name', 'Category ' || mod(i, 20),
+            'path', 'Group ' || mod(i, 5) || '/Category ' || mod(i, 20),
+            'depth', 2,
+            'level_1', 'Group ' || mod(i, 5),
+            'level_2', 'Category ' || mod(i, 20)
+        ),
+        'transaction', jsonb_build_object(
+            'ID', md5('transaction' || i),
+            'date', to_char(date '2015-01-01' + (random() * 3650)::int, 'YYYY-MM-DD'),
+            'name', 'Payee ' || mod(i, 500),
+            'payee', 'Payee ' || mod(i, 500),
+            'payee_key', 'payee ' || mod(i, 500),
+            'account', jsonb_build_object(
+                'ID', md5('account' || mod(i, 8)), 'name', 'Account ' || mod(i, 8), 'hidden', (mod(i, 8) = 7)::int
+            )
+        )
+    )
+FROM generate_series(1, %s) AS i;
+ANALYZE "{table}";
+"""
+
+# dashboard variables overridden for the benchmark
+BENCH_VARIABLES = {
+    # dashboards are usually looked at per tenant
+    'tenant': f"'{TENANTS[0]}'",
+    'search': "'payee 42'",
+}
+
+TIME_FILTER_RE = re.compile(r'\$__timeFilter\(([^()]*(?:\([^()]*\)[^()]*)*)\)')
+VARIABLE_RE = re.compile(r'\$\{(\w+)(?::\w+)?\}|\$(\w+)')
+
+
+@classyclick.command(context_settings={'show_default': True})
+class QueryPlans:
+    """
+    Run the panel queries of the Grafana dashboard under EXPLAIN (ANALYZE, BUFFERS) against generated datasets
+    of different sizes, flagging sequential scans on large tables and latency regressions against a saved baseline.
+    """
+
+    table: str = classyclick.option(default='pocketmoney-bench', help='Prefix of the generated dataset tables')
+    sizes: list[int] = classyclick.option(
+        multiple=True, default=[10_000, 100_000, 1_000_000], help='Number of splits of each generated dataset'
+    )
+    pg_host: str = classyclick.option(default='localhost')
+    pg_port: int = classyclick.option(default=5432)
+    pg_user: str = classyclick.option(default='postgres')
+    pg_password: str = classyclick.option(default='changeme')
+    pg_database: str = classyclick.option(default='dev')
+    dashboard: Path = classyclick.option(
+        default=Path(__file__).parent / 'dashboard.sample.json', help='Path to the dashboard export'
+    )
+    time_from: str = classyclick.option(default='2020-01-01T00:00:00Z', help='Value for $__timeFrom()')
+    time_to: str = classyclick.option(default='2025-01-01T00:00:00Z', help='Value for $__timeTo()')
+    runs: int = classyclick.option(default=3, help='Run each query this many times and keep the fastest')
+    seq_scan_rows: int = classyclick.option(default=50_000, help='Flag sequential scans on tables larger than this')
+    tolerance: float = classyclick.option(default=1.5, help='Flag queries slower than baseline latency * tolerance')
+    baseline: Path = classyclick.option(
+        default=Path(__file__).parent / 'query_plans.baseline.json', help='Path to the saved baseline'
+    )
+    save_baseline: bool = classyclick.option(help='Save the results as the new baseline')
+    regenerate: bool = classyclick.option(help='Regenerate the datasets, even if they already exist')
+
+    @cached_property
+    def client(self):
+        return psycopg2.connect(
+            host=self.pg_host,
+            port=self.pg_port,
+            database=self.pg_database,
+            user=self.pg_user,
+            password=self.pg_password,
+        )
+
+    @cached_property
+    def variables(self):
+        """dashboard variables, resolved to the value used when "All" (or the current value) is selected"""
+        variables = {}
+        for var in json.loads(self.dashboard.read_text())['templating']['list']:
+            value = var.get('current', {}).get('value')
+            if var.get('includeAll') and value in ('$__all', ['$__all']):
+                value = var.get('allValue') or ','.join(f"'{opt['value']}'" for opt in var.get('options', []))
+            elif isinstance(value, list):
+                value = ','.join(value)
+            variables[var['name']] = value
+        return variables
+
+    def panel_queries(self, panels=None):
+        """SQL of the panels and of the query variables (run on every dashboard load) of the dashboard"""
+        if panels is None:
+            dashboard = json.loads(self.dashboard.read_text())
+            for var in dashboard['templating']['list']:
+                query = var.get('query')
+                # newer Grafana versions store the query as an object
+                if isinstance(query, dict):
+                    query = query.get('rawSql')
+                if var.get('type') == 'query' and query:
+                    yield f'Variable {var["name"]}', query
+            panels = dashboard['panels']
+        for panel in panels:
+            # collapsed rows nest their panels
+            yield from self.panel_queries(panel.get('panels', []))
+            for target in panel.get('targets', []):
+                if target.get('rawSql'):
+                    yield f'{panel.get("title")} [{target.get("refId", "A")}]', target['rawSql']
+
+    def render(self, sql, table):
+        """Replace Grafana macros and variables with the values used for the benchmark"""
+        time_range = f"'{self.time_from}' AND '{self.time_to}'"
+        sql = TIME_FILTER_RE.sub(lambda m: f'{m.group(1)} BETWEEN {time_range}', sql)
+        sql = sql.replace('$__timeFrom()', f"'{self.time_from}'").replace('$__timeTo()', f"'{self.time_to}'")
+        variables = {**self.variables, **BENCH_VARIABLES, 'database': table}
+        return VARIABLE_RE.sub(lambda m: str(variables.get(m.group(1) or m.group(2), m.group(0))), sql)
+
+    @cached_property
+    def schema_hash(self):
+        """hash of the table and dataset definitions, so datasets of an older schema are never reused"""
+        return hashlib.sha256((table_ddl(self.table) + DATASET_SQL).encode()).hexdigest()[:8]
+
+    @cached_property
+    def relation_rows(self):
+        """estimated number of rows of each relation scanned"""
+        return {}
+
+    def estimated_rows(self, relation):
+        if relation not in self.relation_rows:
+            cursor = self.client.cursor()
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', (relation,))
+            self.relation_rows[relation] = cursor.fetchone()[0]
+            self.client.rollback()
+        return self.relation_rows[relation]
+
+    def ensure_dataset(self, table, size):
+        cursor = self.client.cursor()
+        if not self.regenerate:
+            try:
+                cursor.execute(f'SELECT count(*) FROM "{table}"')
+                if cursor.fetchone()[0] == size:
+                    return
+            except psycopg2.errors.UndefinedTable:
+                """dataset does not exist yet"""
+            self.client.rollback()
+        self.drop_stale_datasets(size)
+        click.echo(f'Generating {size} splits in {table}...')
+        cursor.execute(table_ddl(table))
+        for tenant in TENANTS:
+            cursor.execute(partition_ddl(table, tenant))
+        cursor.execute(DATASET_SQL.format(table=table), (size,))
+        self.client.commit()
+
+    def drop_stale_datasets(self, size):
+        """Drop the datasets of `size` generated for an older schema (ie: with another `schema_hash`)"""
+        stale_re = re.compile(rf'{re.escape(self.table)}-{size}-(?!{self.schema_hash}$)[0-9a-f]{{8}}')
+        cursor = self.client.cursor()
+        # partitions are dropped along with their table
+        cursor.execute("SELECT relname FROM pg_class WHERE relkind IN ('r', 'p') AND NOT relispartition")
+        for (relation,) in cursor.fetchall():
+            if stale_re.fullmatch(relation):
+                click.echo(f'Dropping stale dataset {relation}...')
+                cursor.execute(f'DROP TABLE "{relation}"')
+        self.client.commit()
+
+    def explain(self, sql):
+        cursor = self.client.cursor()
+        best = None
+        for _ in range(self.runs):
+            cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}')
+            result = cursor.fetchone()[0][0]
+            if best is None or result['Execution Time'] < best['Execution Time']:
+                best = result
+        self.client.rollback()
+        return best
+
+    def plan_nodes(self, node):
+        yield node
+        for child in node.get('Plans', []):
+            yield from self.plan_nodes(child)
+
+    def measure(self, sql):
+        result = self.explain(sql)
+        nodes = list(self.plan_nodes(result['Plan']))
+        # small tables (or tenant partitions) are expected to be scanned sequentially
+        seq_scans = [
+            node['Relation Name']
+            for node in nodes
+            if node['Node Type'] == 'Seq Scan' and self.estimated_rows(node['Relation Name']) > self.seq_scan_rows
+        ]
+        return {
+            'latency_ms': result['Execution Time'],
+            'planning_ms': result['Planning Time'],
+            'plan': [node['Node Type'] for node in nodes],
+            'seq_scans': seq_scans,
+            'shared_hit_blocks': result['Plan'].get('Shared Hit Blocks', 0),
+            'shared_read_blocks': result['Plan'].get('Shared Read Blocks', 0),
+        }
+
+    def compare(self, results, baseline):
+        issues = []
+        for key, result in results.items():
+            for relation in result['seq_scans']:
+                issues.append(f'{key}: sequential scan on {relation}')
+            previous = baseline.get(key)
+            if previous is None:
+                continue
+            if result['latency_ms'] > previous['latency_ms'] * self.tolerance:
+                issues.append(
+                    f'{key}: latency regression {previous["latency_ms"]:.1f}ms -> {result["latency_ms"]:.1f}ms'
+                )
+            if result['plan'] != previous['plan']:
+                issues.append(f'{key}: plan changed {" > ".join(previous["plan"])} -> {" > ".join(result["plan"])}')
+        return issues
+
+    def __call__(self):
+        results = {}
+        for size in self.sizes:
+            table = f'{self.table}-{size}-{self.schema_hash}'
+            self.ensure_dataset(table, size)
+            for name, sql in self.panel_queries():
+                key = f'{name} @ {size}'
+                results[key] = self.measure(self.render(sql, table))
+                click.echo(
+                    f'{key}: {results[key]["latency_ms"]:.1f}ms, '
+                    f'{results[key]["shared_hit_blocks"]} hit / {results[key]["shared_read_blocks"]} read blocks, '
+                    f'{" > ".join(results[key]["plan"])}'
+                )
+
+        if self.save_baseline:
+            self.baseline.write_text(json.dumps(results, indent=2))
+            click.echo(f'Baseline saved to {self.baseline}')
+            return
+
+        baseline = json.loads(self.baseline.read_text()) if self.baseline.exists() else {}
+        issues = self.compare(results, baseline)
+        for issue in issues:
+            click.echo(f'! {issue}', err=True)
+        if issues:
+            raise click.ClickException(f'{len(issues)} issue(s) found')
+
+
+if __name__ == '__main__':
+    QueryPlans()
@@ -1,10 +1,23 @@
 #!/usr/bin/env python3
 
 import json
+import os
 import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from itertools import repeat
 from pathlib import Path
 
+sys.path.append(str(Path(__file__).parent.parent))
+
 import classyclick
+import click
+
+from utils.projection import PROJECTIONS, table_columns
+
+# memory-map up to 256MiB of the database file instead of copying pages through the page cache
+MMAP_SIZE = 256 * 1024 * 1024
 
 
 @classyclick.command()
@@ -27,6 +40,13 @@ class DBLoader:
     db_path: Path = classyclick.argument()
     output: Path = classyclick.option(default='pocketmoney_db_dump.json', help='Path to save the converted JSON file')
     full: bool = classyclick.option(help='Dump all tables, not just the pre-defined ones')
+    jobs: int = classyclick.option(
+        default=os.cpu_count(), help='Number of worker processes used to dump tables in parallel (with --full)'
+    )
+    projection: str = classyclick.option(
+        default='default', type=click.Choice(list(PROJECTIONS)), help='Only load the columns used by this backend'
+    )
+    all_columns: bool = classyclick.option(help='Load all columns, ignoring the projection')
 
     def __call__(self):
         # Load the database
@@ -49,54 +69,31 @@ class DBLoader:
         """
         Load any SQLite database and return its contents as a dictionary.
 
-        Args:
-            db_path (str): Path to the SQLite database file
+        The database is opened read-only. With `--full`, tables are dumped in parallel by `--jobs` worker processes,
+        each with its own connection.
 
         Returns:
             dict: Dictionary containing the database contents
         """
         try:
-            # Connect to the SQLite database
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row  # This enables column access by name
-
             # Get all tables in the database
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            tables = cursor.fetchall()
-
-            # Create a dictionary to store all data
-            db_data = {}
-
-            # For each table, get its schema and data
-            for table in tables:
-                table_name = table[0]
-                if not self.full and table_name not in self.TABLES_TO_DUMP:
-                    continue
-
-                # Get table schema
-                cursor.execute(f'PRAGMA table_info({table_name});')
-                columns = cursor.fetchall()
-
-                # Get table data
-                cursor.execute(f'SELECT * FROM {table_name};')
-                rows = cursor.fetchall()
-
-                # Convert rows to list of dictionaries
-                table_data = []
-                for row in rows:
-                    row_dict = dict(row)
-                    # Convert any binary data to hex string for JSON serialization
-                    for key, value in row_dict.items():
-                        if isinstance(value, bytes):
-                            row_dict[key] = value.hex()
-                    table_data.append(row_dict)
-
-                # Store table info in the main dictionary
-                db_data[table_name] = {'schema': [dict(col) for col in columns], 'data': table_data}
-
-            conn.close()
-            return db_data
+            with closing(connect_readonly(self.db_path)) as conn:
+                tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table';")]
+            if not self.full:
+                tables = [table_name for table_name in tables if table_name in self.TABLES_TO_DUMP]
+
+            if self.all_columns:
+                columns = [None] * len(tables)
+            else:
+                columns = [table_columns(table_name, self.projection) for table_name in tables]
+
+            if self.full and self.jobs > 1 and len(tables) > 1:
+                with ProcessPoolExecutor(max_workers=min(self.jobs, len(tables))) as executor:
+                    dumps = list(executor.map(dump_table, repeat(self.db_path), tables, columns))
+            else:
+                dumps = [dump_table(self.db_path, *args) for args in zip(tables, columns)]
+
+            return dict(zip(tables, dumps))
 
         except sqlite3.Error as e:
             print(f'SQLite error: {e}')
@@ -106,5 +103,50 @@ class DBLoader:
             return None
 
 
+def connect_readonly(db_path: Path):
+    """
+    Open the database read-only, so each worker can use its own connection on the same file.
+    It is also opened as immutable (no locks taken) unless a `-wal` or `-journal` file sits next to it,
+    as those would be ignored and committed but not yet checkpointed changes would be missing.
+    """
+    db_path = db_path.resolve()
+    params = 'mode=ro'
+    if not any(db_path.with_name(f'{db_path.name}-{suffix}').exists() for suffix in ('wal', 'journal')):
+        params += '&immutable=1'
+    conn = sqlite3.connect(f'{db_path.as_uri()}?{params}', uri=True)
+    conn.execute(f'PRAGMA mmap_size={MMAP_SIZE};')
+    return conn
+
+
+def quote_identifier(name: str):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def dump_table(db_path: Path, table_name: str, columns: list[str] | None = None):
+    """
+    Dump a single table (schema and data) using its own connection, so it can run in a worker process.
+    Only `columns` are read from the table, if specified.
+    """
+    with closing(connect_readonly(db_path)) as conn:
+        # Get table schema
+        conn.row_factory = sqlite3.Row
+        schema = [dict(col) for col in conn.execute(f'PRAGMA table_info({quote_identifier(table_name)});')]
+        conn.row_factory = None
+        if columns is not None:
+            schema = [col for col in schema if col['name'] in columns]
+
+        # Convert any binary data to hex string for JSON serialization, column by column within SQLite,
+        # instead of checking every value of every row in Python
+        columns = [col['name'] for col in schema]
+        select = ', '.join(
+            f"CASE typeof({col}) WHEN 'blob' THEN lower(hex({col})) ELSE {col} END"
+            for col in map(quote_identifier, columns)
+        )
+        rows = conn.execute(f'SELECT {select} FROM {quote_identifier(table_name)};')
+        data = [dict(zip(columns, row)) for row in rows]
+
+    return {'schema': schema, 'data': data}
+
+
 if __name__ == '__main__':
     DBLoader()
@@ -0,0 +1,149 @@
+import json
+import re
+import unicodedata
+from dataclasses import dataclass
+from functools import cached_property
+from pathlib import Path
+
+import click
+
+from utils.db_loader import DBLoader
+from utils.projection import project
+
+# trailing store / location numbers, such as `#123`, `store 0042` or `no. 7`
+STORE_NUMBER_RE = re.compile(r'(?:\s*(?:#|\b(?:store|no|nr)\b\.?)\s*\d+)+\W*$')
+
+
+def payee_key(payee: str | None):
+    """
+    Normalize a payee for lookups and grouping: case and accents folded, punctuation and trailing store numbers
+    dropped, so `Café Lisboa #123` and `CAFE LISBOA` share the same key (while `7-Eleven` keeps its digit).
+    """
+    if not payee:
+        return None
+    payee = ''.join(c for c in unicodedata.normalize('NFKD', payee) if not unicodedata.combining(c)).casefold()
+    # keep the payee as is if it is nothing but a store number
+    payee = STORE_NUMBER_RE.sub('', payee) or payee
+    return ' '.join(re.sub(r'[\W_]+', ' ', payee).split()) or None
+
+
+@dataclass
+class Household:
+    """
+    A PocketMoney database (or its JSON dump, as generated by `db_loader.py`) pushed as a single tenant.
+    """
+
+    tenant: str
+    input: Path
+    backend: str = 'default'
+
+    @classmethod
+    def from_spec(cls, spec: str, backend: str = 'default'):
+        """
+        Parse `TENANT=PATH` or just `PATH`, in which case the file name (without extension) is used as tenant.
+        """
+        tenant, sep, path = spec.partition('=')
+        if not sep:
+            path = spec
+            tenant = Path(path).stem
+        return cls(tenant=tenant, input=Path(path), backend=backend)
+
+    @cached_property
+    def data(self):
+        if self.input.suffix == '.pmdb':
+            loader = DBLoader.classy(
+                db_path=self.input, output=None, full=False, jobs=1, projection=self.backend, all_columns=False
+            )
+            data = loader.load_pocketmoney_db()
+            if data is None:
+                raise ValueError(f'Failed to load {self.input}')
+            return data
+        return project(json.loads(self.input.read_text()), self.backend)
+
+    @cached_property
+    def accounts(self):
+        objs = {}
+        for obj in self.data['ICAccount']['data']:
+            if obj['ID'] in objs:
+                raise ValueError(f'Account {obj["ID"]} already exists')
+            objs[obj['ID']] = obj
+        return objs
+
+    @cached_property
+    def categories(self):
+        objs = {}
+        for obj in self.data['ICCategory']['data']:
+            if obj['ID'] in objs:
+                raise ValueError(f'Category {obj["ID"]} already exists')
+            objs[obj['ID']] = obj
+        return objs
+
+    @cached_property
+    def category_ancestries(self):
+        """memoized `category_ancestry` results"""
+        return {}
+
+    def category_ancestry(self, category_id, _visiting=()):
+        """Names of the category and all its ancestors, from the root down"""
+        if category_id in self.category_ancestries:
+            return self.category_ancestries[category_id]
+
+        category = self.categories[category_id]
+        parent = category.get('parent')
+        if parent == category_id or parent in _visiting:
+            # cut the cycle instead of failing the whole push because of a single corrupt parent
+            click.echo(f'Category {category_id} is its own ancestor, treating it as a top level category', err=True)
+            ancestry = [category['name']]
+        # top level categories have a parent that is not a category
+        elif parent in self.categories:
+            ancestry = self.category_ancestry(parent, _visiting + (category_id,)) + [category['name']]
+        else:
+            ancestry = [category['name']]
+        self.category_ancestries[category_id] = ancestry
+        return ancestry
+
+    def materialized_category(self, category_id):
+        """Category with its hierarchy materialized: path, depth and the name of each level (`level_1` is the root)"""
+        category = self.categories[category_id]
+        if 'path' not in category:
+            ancestry = self.category_ancestry(category_id)
+            category['path'] = '/'.join(ancestry)
+            category['depth'] = len(ancestry)
+            for level, name in enumerate(ancestry, 1):
+                category[f'level_{level}'] = name
+        return category
+
+    @cached_property
+    def transactions(self):
+        objs = {}
+        for obj in self.data['ICTransaction']['data']:
+            if obj['ID'] in objs:
+                raise ValueError(f'Transaction {obj["ID"]} already exists')
+            obj['account'] = self.accounts[obj['account']]
+            # fall back to the transaction name, as payee is often empty
+            obj['payee_key'] = payee_key(obj.get('payee') or obj.get('name'))
+            objs[obj['ID']] = obj
+        return objs
+
+    def check_references(self):
+        """Raise if a split references a missing transaction or category, without building any document"""
+        for trans in self.data['ICTransactionSplit']['data']:
+            if trans['transaction'] not in self.transactions:
+                raise ValueError(f'Split {trans["ID"]} references missing transaction {trans["transaction"]}')
+            if trans['category'] and trans['category'] not in self.categories:
+                raise ValueError(f'Split {trans["ID"]} references missing category {trans["category"]}')
+
+    @property
+    def split_count(self):
+        return len(self.data['ICTransactionSplit']['data'])
+
+    def splits(self):
+        """Transaction splits, with their transaction (and account) and category embedded and tagged with the tenant"""
+        for trans in self.data['ICTransactionSplit']['data']:
+            trans['tenant'] = self.tenant
+            trans['amount'] = float(trans['amount'])
+            trans['transaction'] = self.transactions[trans['transaction']]
+            if trans['category']:
+                trans['category'] = self.materialized_category(trans['category'])
+
+            yield trans
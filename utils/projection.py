@@ -0,0 +1,38 @@
+"""
+Columns of the PocketMoney tables that are loaded and shipped to each backend.
+
+Most of the PocketMoney columns are not used by the dashboards (and are null most of the time), so `db_loader.py`
+only selects the projected columns and the pushers drop anything else still found in a dump (ie: older dumps).
+Tables not listed in a projection keep all their columns.
+"""
+
+DEFAULT_PROJECTION = {
+    'ICAccount': ['ID', 'name', 'hidden', 'includedInTotal', 'currency', 'type'],
+    'ICCategory': ['ID', 'parent', 'name', 'expense', 'income'],
+    'ICTransaction': ['ID', 'account', 'date', 'name', 'payee', 'comment', 'type', 'number', 'status'],
+    'ICTransactionSplit': ['ID', 'transaction', 'amount', 'comment', 'category', 'ignoredInReports', 'refund'],
+}
+
+PROJECTIONS = {
+    'default': DEFAULT_PROJECTION,
+    # override tables here to ship more (or less) columns to a specific backend
+    'opensearch': {**DEFAULT_PROJECTION},
+    'postgres': {**DEFAULT_PROJECTION},
+}
+
+
+def table_columns(table_name: str, backend: str = 'default'):
+    """Projected columns of `table_name` for `backend`, None if all columns are to be kept"""
+    return PROJECTIONS[backend].get(table_name)
+
+
+def project(db_data: dict, backend: str = 'default'):
+    """Drop the columns not projected for `backend` from a database dump (as generated by `db_loader.py`)"""
+    for table_name, table_info in db_data.items():
+        columns = table_columns(table_name, backend)
+        if columns is None:
+            continue
+        if 'schema' in table_info:
+            table_info['schema'] = [col for col in table_info['schema'] if col['name'] in columns]
+        table_info['data'] = [{col: row[col] for col in columns if col in row} for row in table_info['data']]
+    return db_data